@@ -1,63 +1,75 @@
 #!/usr/bin/env python3
 """Flask API wrapper for HYMN simulator."""
 
-from flask import Flask, request, jsonify, send_from_directory, session
-from simulator import CPU, MemoryLocation
-from collections import deque
+from flask import Flask, Response, request, jsonify, send_from_directory
+from flask.json.provider import DefaultJSONProvider
+from simulator import (ADD, CPU, HALT, INSTR_TO_OPCODE, JPOS, JUMP, JZER, LOAD,
+                       MemoryLocation, STOR, SUB, check_operand,
+                       compile_program, dispatch_opcode, valid_operand)
+from array import array
+from collections import OrderedDict
 from threading import RLock
-from time import monotonic, time
-from datetime import timedelta
+from time import monotonic, sleep, time
+from functools import lru_cache, partial
+import orjson
 import secrets
 import os
 
 MAX_SESSIONS = int(os.environ.get("MAX_SESSIONS", "1000"))
 SESSION_TTL_SECONDS = int(os.environ.get("SESSION_TTL_SECONDS", "7200"))
 EXECUTION_TIMEOUT_SECONDS = int(os.environ.get("EXECUTION_TIMEOUT_SECONDS", "60"))
+STREAM_INTERVAL_SECONDS = 0.1
+SESSION_HEADER = "X-Hymn-Session"
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson's C encoder and decoder."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 
 app = Flask(__name__, static_folder="static")
-app.secret_key = os.environ.get("FLASK_SECRET_KEY", secrets.token_hex(32))
-app.config["SESSION_COOKIE_HTTPONLY"] = True
-app.config["SESSION_COOKIE_SAMESITE"] = "Lax"
-app.config["SESSION_COOKIE_SECURE"] = (
-    os.environ.get("SESSION_COOKIE_SECURE", "0").lower() in ("1", "true", "yes")
-)
-app.config["PERMANENT_SESSION_LIFETIME"] = timedelta(seconds=SESSION_TTL_SECONDS)
+app.json = OrjsonProvider(app)
+# Bodies are at most a short program plus a few fields; cap parser work.
+app.config["MAX_CONTENT_LENGTH"] = 64 * 1024
 
 
 class SessionStore:
     """Thread-safe in-memory CPU session store with bounded retention."""
 
     def __init__(self, max_sessions=MAX_SESSIONS, ttl_seconds=SESSION_TTL_SECONDS):
-        self._sessions = {}
+        # Ordered least- to most-recently used, so eviction pops from the front.
+        self._sessions = OrderedDict()
         self._session_locks = {}
         self._lock = RLock()
         self._max_sessions = max_sessions
         self._ttl_seconds = ttl_seconds
 
-    def _cleanup_locked(self, now):
-        stale_ids = [
-            sid for sid, (_, last_seen) in self._sessions.items()
-            if now - last_seen > self._ttl_seconds
-        ]
-        for sid in stale_ids:
-            del self._sessions[sid]
-            self._session_locks.pop(sid, None)
+    def _evict_oldest_locked(self):
+        sid, _ = self._sessions.popitem(last=False)
+        self._session_locks.pop(sid, None)
 
-        if len(self._sessions) <= self._max_sessions:
-            return
+    def _cleanup_locked(self, now):
+        while self._sessions:
+            _, last_seen = next(iter(self._sessions.values()))
+            if now - last_seen <= self._ttl_seconds:
+                break
+            self._evict_oldest_locked()
 
         # Evict least-recently-used sessions when above capacity.
-        sorted_sessions = sorted(self._sessions.items(), key=lambda item: item[1][1])
-        overflow = len(self._sessions) - self._max_sessions
-        for sid, _ in sorted_sessions[:overflow]:
-            del self._sessions[sid]
-            self._session_locks.pop(sid, None)
+        while len(self._sessions) > self._max_sessions:
+            self._evict_oldest_locked()
 
     def put(self, session_id, cpu):
         with self._lock:
             now = time()
             self._cleanup_locked(now)
             self._sessions[session_id] = (cpu, now)
+            self._sessions.move_to_end(session_id)
             self._session_locks.setdefault(session_id, RLock())
 
     def get(self, session_id):
@@ -67,6 +79,7 @@ class SessionStore:
                 return None
             cpu, _ = current
             self._sessions[session_id] = (cpu, time())
+            self._sessions.move_to_end(session_id)
             return cpu
 
     def delete(self, session_id):
@@ -86,24 +99,27 @@ class SessionStore:
 sessions = SessionStore()
 
 
+def _json_response(data):
+    """Encode a hot-path response directly, skipping jsonify's overhead."""
+    return Response(orjson.dumps(data), mimetype="application/json")
+
+
 def _request_json():
     return request.get_json(silent=True) or {}
 
 
 def _get_session_id(create=False):
-    session_id = session.get("sid")
-    if isinstance(session_id, str) and session_id:
-        return session_id
+    """Return the session token the client sent in the X-Hymn-Session header."""
+    session_id = request.headers.get(SESSION_HEADER)
     if not create:
-        return None
-
-    session_id = secrets.token_urlsafe(32)
-    session["sid"] = session_id
-    session.permanent = True
-    return session_id
+        return session_id or None
+    # Clients can only resume sessions the server handed out.
+    if session_id and sessions.lock_for(session_id) is not None:
+        return session_id
+    return secrets.token_urlsafe(32)
 
 
-def _cpu_from_request(data):
+def _cpu_from_request():
     session_id = _get_session_id(create=False)
     if session_id is None:
         return None, None, None, (jsonify({"error": "No program loaded"}), 400)
@@ -121,42 +137,152 @@ def _cpu_from_request(data):
     return session_id, cpu, session_lock, None
 
 
+@lru_cache(maxsize=None)
+def _memory_location(decimal):
+    """Return the MemoryLocation shared by every cell holding a value."""
+    return MemoryLocation(decimal=decimal)
+
+
+@lru_cache(maxsize=None)
+def _instr_text(decimal):
+    """Return the formatted instruction for a value, e.g. 'load 3'."""
+    return str(_memory_location(decimal))
+
+
 class SteppableCPU(CPU):
     """Wrapper that adds step-by-step execution without modifying original."""
 
+    # run_all yields to other requests this often. Under gunicorn's gevent
+    # worker time.sleep is monkey-patched, so sleep(0) switches greenlets;
+    # this works because the simulator never blocks inside C code.
+    _YIELD_STEPS = 256
+    # run_n reads the clock for its deadline only once per this many steps.
+    _DEADLINE_CHECK_STEPS = 256
+    # run_n steps a program this many times before compiling it, so short
+    # runs never pay for exec().
+    _COMPILE_AFTER_STEPS = 1024
+    # After this many STORs into compiled code, run_n stops compiling and
+    # steps instead: self-modifying loops would otherwise recompile on every
+    # pass.
+    _MAX_RECOMPILES = 2
+
+    def _init_memory(self):
+        # Memory is a list of shared MemoryLocations plus decoded opcode and
+        # operand lists (see load_program), not CPU's NumPy arrays.
+        self.memory = []
+        self._opcode = []
+        self._operand = []
+        self._input = array('b')
+        self._input_head = 0
+        self.output_buffer = []
+
     def load_program(self, code: str, input_buffer=()):
         self.pc = 0
         self.ac = 0
-        self.memory = [MemoryLocation(decimal=0) for _ in range(30)]
         self.output_buffer = []
-        self._symbol_table = {}
         self.halted = False
         self.error = None
         self.waiting_for_input = False
-        self.source_lines = code.strip().split('\n')
 
-        program = [CPU._strip_comment(line).lower().strip()
-                   for line in code.splitlines() if len(line) > 0]
-        program = [line for line in program if len(line) > 0]
-        program = self._inline_labels(program)
-        self._fill_symbol_table(program)
-        self._assemble(program)
-        self.input_buffer = deque(input_buffer)
+        # compile_program caches by source, so reloading unchanged code (the
+        # usual edit-and-rerun cycle in the UI) skips parsing.
+        _, _, memory_decimal, _, symbols = compile_program(code)
+        self.memory = list(map(_memory_location, memory_decimal.tolist()))
+        self._symbol_table = dict(symbols)
+        self._opcode = [INSTR_TO_OPCODE[m.instruction] for m in self.memory]
+        self._operand = [m.operand for m in self.memory]
+        # Each cell's handler with its operand already bound, for step().
+        self._bound = [self._bind(opcode, operand)
+                       for opcode, operand in zip(self._opcode, self._operand)]
+        self._invalidate()
+        # Pending input: a signed-byte array consumed from _input_head.
+        try:
+            self._input = array('b', input_buffer)
+        except OverflowError:
+            raise ValueError('Input values must be -128 to 127')
+        self._input_head = 0
+        self._memory_view = [{"decimal": m.decimal, "instr": str(m)}
+                             for m in self.memory]
+        self._dirty_mem = set()
+        self._output_cursor = 0
+        self._input_cursor = 0
+
+    def _invalidate(self, address=None):
+        """Drop the compiled program if it baked in the given address."""
+        if address is None:
+            self._entry_points = {0}
+            self._compiled_cells = set()
+            self._compiled_run = None
+            self._warmup_steps = self._COMPILE_AFTER_STEPS
+            self._recompiles = 0
+        elif address in self._compiled_cells:
+            self._compiled_run = None
+
+    def _bind(self, opcode, operand):
+        """Return a zero-argument call that executes one instruction."""
+        opcode = dispatch_opcode(opcode, operand)
+        if valid_operand(opcode, operand):
+            return partial(self._dispatch[opcode], operand)
+        # Only possible in a cell rewritten at run time.
+        return partial(check_operand, opcode, operand)
+
+    def _set_cell(self, address, location):
+        """Store a MemoryLocation and refresh everything derived from it."""
+        self.memory[address] = location
+        opcode = INSTR_TO_OPCODE[location.instruction]
+        self._opcode[address] = opcode
+        self._operand[address] = location.operand
+        self._bound[address] = self._bind(opcode, location.operand)
+        self._dirty_mem.add(address)
+        self._invalidate(address)
+
+    def write_memory(self, address: int, decimal: int):
+        """Overwrite a memory location, keeping decoded state in sync."""
+        self._set_cell(address, _memory_location(decimal))
+
+    def _execute_stor(self, data):
+        # STOR may rewrite code that has been compiled
+        self._set_cell(data, _memory_location(self.ac))
+        self.pc += 1
+
+    def _execute_stor_output(self, data):
+        self.output_buffer.append(self.ac)
+        self.pc += 1
+
+    def memory_locations(self):
+        return list(self.memory)
+
+    def get_state(self):
+        """Return (ac, memory values, output) as plain Python lists."""
+        return (self.ac, [location.decimal for location in self.memory],
+                list(self.output_buffer))
+
+    def run_program(self, program_filename, input_buffer=()):
+        """Load and run a file through run_all(), raising like CPU does."""
+        try:
+            with open(program_filename, 'r') as in_file:
+                self.load_program(in_file.read(), input_buffer)
+        except IOError:
+            raise IOError(f'File {program_filename} not found.')
+        self.run_all()
+        if self.error:
+            raise ValueError(self.error)
+        if self.waiting_for_input:
+            raise IndexError('Input buffer is empty')
 
     def needs_input(self):
         """Check if current instruction is READ and input buffer is empty."""
         if self.halted or self.error:
             return False
-        instruction = self.memory[self.pc].instruction
-        operand = self.memory[self.pc].operand
         # READ is load from address 30
-        is_read = (instruction == 'load' and operand == 30)
-        return is_read and len(self.input_buffer) == 0
-
-    def step(self):
-        if self.halted or self.error:
-            return False
-
+        is_read = self._opcode[self.pc] == LOAD and self._operand[self.pc] == 30
+        return is_read and self._input_head >= len(self._input)
+
+    def _step_nothrow(self):
+        """Execute one instruction, letting handler errors propagate."""
+        pc = self.pc
+        if not 0 <= pc < len(self.memory):
+            raise ValueError(f'Invalid PC {pc}')
         # Check if we need input before executing
         if self.needs_input():
             self.waiting_for_input = True
@@ -164,43 +290,301 @@ class SteppableCPU(CPU):
 
         self.waiting_for_input = False
 
+        if self._opcode[pc] == HALT:
+            self.halted = True
+            return False
+        self._bound[pc]()
+        return True
+
+    def step(self):
+        if self.halted or self.error:
+            return False
         try:
-            if self.memory[self.pc].instruction == 'halt':
-                self.halted = True
-                return False
-            instruction = self.memory[self.pc].instruction
-            operand = self.memory[self.pc].operand
-            self._JUMP_TABLE[instruction](data=operand)
-            return True
+            return self._step_nothrow()
         except Exception as e:
             self.error = str(e)
             return False
 
     def provide_input(self, value: int):
         """Add a value to the input buffer."""
-        self.input_buffer.append(value)
+        if self._input_head == len(self._input):  # reuse the drained array
+            del self._input[:]
+            self._input_cursor -= self._input_head
+            self._input_head = 0
+        self._input.append(value)
+        self.waiting_for_input = False
+
+    def _read_input(self):
+        value = self._input[self._input_head]
+        self._input_head += 1
+        return value
+
+    def _execute_load(self, data):
+        self.ac = self.memory[data].decimal
+        self.pc += 1
+
+    def _execute_load_input(self, data):
+        self.ac = self._read_input()
+        self.pc += 1
+
+    def _execute_add(self, data):
+        self.ac += self.memory[data].decimal
+        self.pc += 1
+
+    def _execute_sub(self, data):
+        self.ac -= self.memory[data].decimal
+        self.pc += 1
+
+    def _store(self, address, value):
+        if address in self._compiled_cells:
+            self._recompiles += 1
+        self._set_cell(address, _memory_location(value))
+
+    def _step_n(self, max_steps):
+        """Execute up to max_steps instructions with step()'s semantics."""
+        steps = 0
+        step = self._step_nothrow
+        try:
+            while steps < max_steps and step():
+                steps += 1
+        finally:
+            self._run_steps = steps
+
+    def _compile_program(self):
+        """Generate run(max_steps), the reachable code as basic blocks."""
+        opcodes, operands = self._opcode, self._operand
+        size = len(opcodes)
+
+        reachable = set()
+        leaders = {pc for pc in self._entry_points if 0 <= pc < size}
+        pending = list(leaders)
+        while pending:
+            pc = pending.pop()
+            if pc in reachable or not 0 <= pc < size:
+                continue
+            reachable.add(pc)
+            opcode, operand = opcodes[pc], operands[pc]
+            if opcode == HALT:
+                continue
+            if opcode in (JUMP, JZER, JPOS):
+                if operand < size:
+                    leaders.add(operand)
+                    pending.append(operand)
+                if opcode == JUMP:
+                    continue
+                leaders.add(pc + 1)
+            pending.append(pc + 1)
+        for pc in reachable:
+            if opcodes[pc] == STOR and operands[pc] in reachable:
+                leaders.add(pc + 1)
+        leaders = sorted(pc for pc in leaders if pc < size)
+
+        # run() keeps PC, AC and its step count in locals, written back to
+        # the CPU on exit even if it raises. It dispatches on the PC with a
+        # binary search over block leaders. It returns once it halts, waits
+        # for input, runs out of steps, reaches a PC it did not compile, or
+        # STORs into a compiled cell (its code is then stale).
+        lines = ['def run(max_steps):',
+                 '    steps = 0',
+                 '    pc = cpu.pc',
+                 '    ac = cpu.ac',
+                 '    try:',
+                 '        while True:']
+
+        def emit_block(pc, indent):
+            pad = ' ' * indent
+            count = 0
+            while pc < size:
+                opcode, operand = opcodes[pc], operands[pc]
+                if opcode == HALT:
+                    lines.append(f'{pad}pc = {pc}')
+                    lines.append(f'{pad}cpu.halted = True')
+                    lines.append(f'{pad}steps += {count}')
+                    lines.append(f'{pad}return')
+                    return
+                if not valid_operand(opcode, operand):
+                    lines.append(f'{pad}pc = {pc}')
+                    lines.append(f'{pad}steps += {count}')
+                    lines.append(f'{pad}check_operand({opcode}, {operand})')
+                    return
+                count += 1
+                if opcode == JUMP:
+                    lines.append(f'{pad}pc = {operand}')
+                    break
+                if opcode in (JZER, JPOS):
+                    test = 'ac == 0' if opcode == JZER else 'ac > 0'
+                    lines.append(f'{pad}pc = {operand} if {test} else {pc + 1}')
+                    break
+                if opcode == LOAD and operand == 30:
+                    lines.append(f'{pad}if cpu._input_head >= len(input):')
+                    lines.append(f'{pad}    pc = {pc}')
+                    lines.append(f'{pad}    cpu.waiting_for_input = True')
+                    lines.append(f'{pad}    steps += {count - 1}')
+                    lines.append(f'{pad}    return')
+                    lines.append(f'{pad}ac = read_input()')
+                elif opcode == LOAD:
+                    lines.append(f'{pad}ac = mem[{operand}].decimal')
+                elif opcode == ADD:
+                    lines.append(f'{pad}ac += mem[{operand}].decimal')
+                elif opcode == SUB:
+                    lines.append(f'{pad}ac -= mem[{operand}].decimal')
+                elif operand == 31:
+                    lines.append(f'{pad}write_output(ac)')
+                else:
+                    # Count the steps before it, in case store() raises.
+                    lines.append(f'{pad}pc = {pc}')
+                    lines.append(f'{pad}steps += {count - 1}')
+                    lines.append(f'{pad}store({operand}, ac)')
+                    count = 1
+                    if operand in reachable:
+                        lines.append(f'{pad}pc = {pc + 1}')
+                        lines.append(f'{pad}steps += 1')
+                        lines.append(f'{pad}return')
+                        return
+                pc += 1
+            else:
+                lines.append(f'{pad}pc = {size}')
+            lines.append(f'{pad}steps += {count}')
+
+        def emit_dispatch(pcs, indent):
+            pad = ' ' * indent
+            if len(pcs) == 1:
+                lines.append(f'{pad}if pc == {pcs[0]}:')
+                emit_block(pcs[0], indent + 4)
+                lines.append(f'{pad}else:')
+                lines.append(f'{pad}    return')
+                return
+            mid = len(pcs) // 2
+            lines.append(f'{pad}if pc < {pcs[mid]}:')
+            emit_dispatch(pcs[:mid], indent + 4)
+            lines.append(f'{pad}else:')
+            emit_dispatch(pcs[mid:], indent + 4)
+
+        emit_dispatch(leaders, 12)
+        lines += ['            if steps >= max_steps:',
+                  '                return',
+                  '    finally:',
+                  '        cpu.pc = pc',
+                  '        cpu.ac = ac',
+                  '        cpu._run_steps = steps']
+
+        namespace = dict(cpu=self, mem=self.memory,
+                         check_operand=check_operand,
+                         store=self._store, input=self._input,
+                         read_input=self._read_input,
+                         write_output=self.output_buffer.append)
+        exec('\n'.join(lines), namespace)
+        self._compiled_cells = reachable
+        self._compiled_leaders = set(leaders)
+        self._compiled_run = namespace['run']
+
+    def run_n(self, max_steps, deadline=float('inf')):
+        """Run about max_steps steps; return the number actually taken."""
+        # May overshoot max_steps by the rest of a basic block, and the
+        # deadline by up to _DEADLINE_CHECK_STEPS steps.
+        steps = 0
+        if self.halted or self.error:
+            return steps
+
         self.waiting_for_input = False
+        try:
+            while steps < max_steps:
+                budget = min(max_steps - steps, self._DEADLINE_CHECK_STEPS)
+                # Both runners leave the steps they took in _run_steps, even
+                # when they raise.
+                self._run_steps = 0
+                try:
+                    if (self._warmup_steps > 0
+                            or self._recompiles > self._MAX_RECOMPILES):
+                        self._step_n(budget)
+                        self._warmup_steps -= self._run_steps
+                    else:
+                        if (self._compiled_run is None
+                                or self.pc not in self._compiled_leaders):
+                            if not 0 <= self.pc < len(self.memory):
+                                raise ValueError(f'Invalid PC {self.pc}')
+                            self._entry_points.add(self.pc)
+                            self._compile_program()
+                        self._compiled_run(budget)
+                finally:
+                    steps += self._run_steps
+                if self.halted or self.waiting_for_input:
+                    break
+                if monotonic() >= deadline:
+                    break
+        except Exception as e:
+            self.error = str(e)
+        return steps
+
+    def stopped(self):
+        """True once the CPU has halted, failed or is waiting for input."""
+        return bool(self.halted or self.error or self.waiting_for_input)
+
+    def time_out(self, timeout_seconds):
+        self.error = f"Execution timed out after {timeout_seconds} seconds"
 
     def run_all(self, timeout_seconds=EXECUTION_TIMEOUT_SECONDS):
-        start = monotonic()
+        """Run until halt, error, input wait or timeout; return steps taken."""
+        deadline = monotonic() + timeout_seconds
         steps = 0
-        while self.step():
-            steps += 1
-            if monotonic() - start >= timeout_seconds:
-                self.error = f"Execution timed out after {timeout_seconds} seconds"
+        while True:
+            steps += self.run_n(self._YIELD_STEPS, deadline)
+            if self.stopped():
                 break
+            if monotonic() >= deadline:
+                self.time_out(timeout_seconds)
+                break
+            sleep(0)
         return steps
 
-    def to_state(self):
-        return {
+    def _sync(self):
+        """Refresh changed memory entries; return what the client has not seen."""
+        memory_view = self._memory_view
+        changed = sorted(self._dirty_mem)
+        for address in changed:
+            decimal = self.memory[address].decimal
+            entry = memory_view[address]
+            entry["decimal"] = decimal
+            entry["instr"] = _instr_text(decimal)
+        self._dirty_mem.clear()
+
+        output_sent = self._output_cursor
+        input_consumed = self._input_head - self._input_cursor
+        self._output_cursor = len(self.output_buffer)
+        self._input_cursor = self._input_head
+        return changed, output_sent, input_consumed
+
+    def to_state(self, include_symbols=False):
+        """Return a JSON-ready snapshot of the CPU."""
+        # Memory entries are refreshed in place, so serialize before the
+        # CPU runs again.
+        self._sync()
+        state = {
             "pc": self.pc,
             "ac": self.ac,
-            "memory": [{"decimal": m.decimal, "instr": str(m)} for m in self.memory],
+            "memory": self._memory_view,
             "output": list(self.output_buffer),
-            "input": list(self.input_buffer),
+            "input": self._input[self._input_head:].tolist(),
+            "halted": self.halted,
+            "error": self.error,
+            "waiting_for_input": self.waiting_for_input,
+        }
+        if include_symbols:
+            state["symbols"] = self._symbol_table
+        return state
+
+    def to_delta(self):
+        """Return only what changed since the last to_state() or to_delta()."""
+        changed, output_sent, input_consumed = self._sync()
+        return {
+            "pc": self.pc,
+            "ac": self.ac,
+            "changed": [{"addr": address, **self._memory_view[address]}
+                        for address in changed],
+            "output_appended": self.output_buffer[output_sent:],
+            "input_consumed": input_consumed,
             "halted": self.halted,
             "error": self.error,
-            "symbols": self._symbol_table,
             "waiting_for_input": self.waiting_for_input,
         }
 
@@ -225,52 +609,97 @@ def load():
     data = _request_json()
     code = data.get("code", "")
     input_buf = data.get("input", [])
-    session_id = _get_session_id(create=True)
-    session_lock = sessions.lock_for(session_id, create=True)
 
     try:
         input_buf = [int(x) for x in input_buf if str(x).strip()]
     except ValueError:
         return jsonify({"error": "Invalid input buffer"}), 400
 
+    session_id = _get_session_id(create=True)
+    session_lock = sessions.lock_for(session_id, create=True)
     with session_lock:
         cpu = SteppableCPU()
         try:
             cpu.load_program(code, tuple(input_buf))
         except Exception as e:
+            # Only a session keeps its lock alive; a new token has none.
+            if sessions.get(session_id) is None:
+                sessions.delete(session_id)
             return jsonify({"error": str(e)}), 400
 
         sessions.put(session_id, cpu)
-        return jsonify(cpu.to_state())
+        return jsonify({"token": session_id, **cpu.to_state(include_symbols=True)})
 
 
 @app.route("/api/step", methods=["POST"])
 def step():
-    _, cpu, session_lock, error = _cpu_from_request(_request_json())
+    _, cpu, session_lock, error = _cpu_from_request()
     if error:
         return error
     try:
         cpu.step()
-        return jsonify(cpu.to_state())
+        return _json_response(cpu.to_state())
+    finally:
+        session_lock.release()
+
+
+@app.route("/api/step_delta", methods=["POST"])
+def step_delta():
+    """Step once and return only the state that changed (see to_delta)."""
+    _, cpu, session_lock, error = _cpu_from_request()
+    if error:
+        return error
+    try:
+        cpu.step()
+        return _json_response(cpu.to_delta())
     finally:
         session_lock.release()
 
 
 @app.route("/api/run", methods=["POST"])
 def run():
-    _, cpu, session_lock, error = _cpu_from_request(_request_json())
+    _, cpu, session_lock, error = _cpu_from_request()
     if error:
         return error
     try:
         cpu.run_all(timeout_seconds=EXECUTION_TIMEOUT_SECONDS)
-        return jsonify(cpu.to_state())
+        return _json_response(cpu.to_state())
     finally:
         session_lock.release()
 
 
+@app.route("/api/run_stream", methods=["POST"])
+def run_stream():
+    """Run the program, streaming to_delta() snapshots as Server-Sent Events."""
+    _, cpu, session_lock, error = _cpu_from_request()
+    if error:
+        return error
+
+    timeout_seconds = EXECUTION_TIMEOUT_SECONDS
+    deadline = monotonic() + timeout_seconds
+
+    def events():
+        next_event = monotonic() + STREAM_INTERVAL_SECONDS
+        while True:
+            cpu.run_n(SteppableCPU._YIELD_STEPS, deadline)
+            now = monotonic()
+            if not cpu.stopped() and now >= deadline:
+                cpu.time_out(timeout_seconds)
+            if cpu.stopped() or now >= next_event:
+                yield b"data: " + orjson.dumps(cpu.to_delta()) + b"\n\n"
+                next_event = now + STREAM_INTERVAL_SECONDS
+            if cpu.stopped():
+                break
+            sleep(0)
+
+    response = Response(events(), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.call_on_close(session_lock.release)
+    return response
+
+
 @app.route("/api/reset", methods=["POST"])
 def reset():
-    _request_json()
     session_id = _get_session_id(create=False)
     if session_id is None:
         return jsonify({"status": "reset"})
@@ -287,7 +716,7 @@ def reset():
 def update_memory():
     """Update a memory location by address and decimal value."""
     data = _request_json()
-    _, cpu, session_lock, error = _cpu_from_request(data)
+    _, cpu, session_lock, error = _cpu_from_request()
     if error:
         return error
 
@@ -305,7 +734,7 @@ def update_memory():
             return jsonify({"error": "Invalid value (must be -128 to 127)"}), 400
 
         try:
-            cpu.memory[address] = MemoryLocation(decimal=decimal)
+            cpu.write_memory(address, decimal)
             return jsonify(cpu.to_state())
         except Exception as e:
             return jsonify({"error": str(e)}), 400
@@ -317,7 +746,7 @@ def update_memory():
 def update_register():
     """Update PC or AC register."""
     data = _request_json()
-    _, cpu, session_lock, error = _cpu_from_request(data)
+    _, cpu, session_lock, error = _cpu_from_request()
     if error:
         return error
 
@@ -348,7 +777,7 @@ def update_register():
 def provide_input():
     """Provide input value when CPU is waiting for input."""
     data = _request_json()
-    _, cpu, session_lock, error = _cpu_from_request(data)
+    _, cpu, session_lock, error = _cpu_from_request()
     if error:
         return error
 
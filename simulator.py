@@ -1,20 +1,63 @@
 
 import numpy as np
-from collections import deque
+from functools import lru_cache
+
+# Name <-> opcode tables for the 3-bit opcode field of a memory cell.
+INSTR_TO_OPCODE = {'halt': 0, 'jump': 1, 'jzer': 2, 'jpos': 3, 'load': 4,
+                   'stor': 5, 'add': 6, 'sub': 7}
+OPCODE_TO_INSTR = ('halt', 'jump', 'jzer', 'jpos', 'load', 'stor', 'add',
+                   'sub')
+HALT, JUMP, JZER, JPOS, LOAD, STOR, ADD, SUB = range(8)
+
+# Other mnemonics the assembler accepts; _expand_pseudo_ops rewrites them.
+PSEUDO_OPS = frozenset({'read', 'write', 'store'})
+
+# Extended opcodes for READ (LOAD 30) and WRITE (STOR 31), picked when a
+# cell is decoded so that LOAD and STOR themselves only touch memory.
+LOAD_INPUT, STOR_OUTPUT = 8, 9
+
+# Super-instructions: a cell in CPU.fused holding one of these (0 otherwise)
+# starts a run of cells that simulator_jit executes as a single step.
+LOAD_ADD_STOR, LOAD_SUB_STOR, LOAD_WRITE, SUB_JPOS = range(10, 14)
+_FUSED_LENGTH = {LOAD_ADD_STOR: 3, LOAD_SUB_STOR: 3, LOAD_WRITE: 2,
+                 SUB_JPOS: 2}
+
+
+def dispatch_opcode(opcode, operand):
+    """Return the opcode a cell executes as, extended for the I/O ports."""
+    if opcode == LOAD and operand == 30:
+        return LOAD_INPUT
+    if opcode == STOR and operand == 31:
+        return STOR_OUTPUT
+    return opcode
+
+
+def valid_operand(opcode, operand):
+    """True if a 5-bit operand is a legal address for the opcode."""
+    return (operand < 30 or opcode in (HALT, LOAD_INPUT, STOR_OUTPUT)
+            or (opcode == LOAD and operand == 30)
+            or (opcode == STOR and operand == 31))
+
+
+def check_operand(opcode, operand):
+    """Raise ValueError unless the operand is legal for the opcode."""
+    if not valid_operand(opcode, operand):
+        raise ValueError(f'Invalid {OPCODE_TO_INSTR[opcode].upper()} address '
+                         f'{operand}')
+
+
+# Initial capacity of CPU.output_buffer, which doubles whenever it fills.
+_OUTPUT_CHUNK = 256
 
 
 class MemoryLocation:
+    __slots__ = ('instruction', 'operand', 'decimal')
+
     def __init__(self, instruction=(), decimal=0):
         if instruction and decimal:
             raise ValueError('When setting a memory location, specify only the'
                              ' instruction or data value, not both')
 
-        INSTR_TO_OPCODE = {'halt': 0, 'jump': 1, 'jzer': 2, 'jpos': 3,
-                           'load': 4, 'stor': 5, 'store': 5, 'add': 6,
-                           'sub': 7, 'read': 4, 'write': 5}
-        OPCODE_TO_INSTR = ['halt',  'jump', 'jzer', 'jpos', 'load', 'stor',
-                            'add', 'sub']
-
         if instruction:
             self.instruction = instruction[0]
             self.operand = instruction[1]
@@ -22,12 +65,12 @@ class MemoryLocation:
             self.decimal = (self.decimal - 256 if self.decimal >= 128
                             else self.decimal)
         else:
-            self.decimal = decimal
-            binary = np.binary_repr(self.decimal, width=8)
-            if len(binary) > 8:
+            if not -128 <= decimal < 128:
                 raise ValueError('Overflow!')
-            self.instruction = OPCODE_TO_INSTR[int(binary[:3], base=2)]
-            self.operand = int(binary[3:], base=2)
+            self.decimal = decimal
+            bits = decimal & 0xFF  # two's complement byte
+            self.instruction = OPCODE_TO_INSTR[bits >> 5]
+            self.operand = bits & 0x1F
 
     def __repr__(self):
         return '{} {}'.format(self.instruction, self.operand)
@@ -36,99 +79,122 @@ class MemoryLocation:
         return '{} {}'.format(self.instruction, self.operand)
 
 
+def _fuse(opcodes, operands):
+    """Mark the first cell of each super-instruction, e.g. LOAD; ADD; STOR."""
+    # Only the first cell is marked, so a jump into the middle of a run
+    # executes its remaining cells one at a time.
+    fused = np.zeros(len(opcodes), dtype=np.uint8)
+    ops = opcodes.tolist() + [HALT, HALT]
+    args = operands.tolist() + [0, 0]
+    pc = 0
+    while pc < len(opcodes):
+        first, second, third = ops[pc:pc + 3]
+        a, b, c = args[pc:pc + 3]
+        fusion = 0
+        if first == LOAD and a < 30:
+            if second in (ADD, SUB) and b < 30 and third == STOR and c < 30:
+                fusion = LOAD_ADD_STOR if second == ADD else LOAD_SUB_STOR
+            elif second == STOR_OUTPUT:
+                fusion = LOAD_WRITE
+        elif first == SUB and a < 30 and second == JPOS and b < 30:
+            fusion = SUB_JPOS
+        if fusion:
+            fused[pc] = fusion
+            pc += _FUSED_LENGTH[fusion]
+        else:
+            pc += 1
+    return fused
+
+
 class CPU:
     def __init__(self):
         self.pc = 0  # program counter
         self.ac = 0  # accumulator
-        self.memory = [MemoryLocation(decimal=0) for i in range(30)]
-        self.input_buffer = deque()
-        self.output_buffer = list()
+        self._init_memory()
         self._symbol_table = dict()
-        self._JUMP_TABLE = {'halt':  self._execute_halt,
-                            'jump':  self._execute_jump,
-                            'jzer':  self._execute_jzer,
-                            'jpos':  self._execute_jpos,
-                            'load':  self._execute_load,
-                            'stor':  self._execute_stor,
-                            'store': self._execute_stor,
-                            'add':   self._execute_add,
-                            'sub':   self._execute_sub,
-                            'read':  self._execute_load,
-                            'write': self._execute_stor}
-
-    def _execute_halt(self):
+        # Handlers indexed by opcode (see dispatch_opcode), each called
+        # with the operand.
+        self._dispatch = (self._execute_halt, self._execute_jump,
+                          self._execute_jzer, self._execute_jpos,
+                          self._execute_load, self._execute_stor,
+                          self._execute_add, self._execute_sub,
+                          self._execute_load_input, self._execute_stor_output)
+
+    def _init_memory(self):
+        # Memory as parallel arrays: each cell's opcode and operand fields
+        # for fetch, and its signed value for data reads.
+        self.opcodes = np.zeros(30, dtype=np.uint8)
+        self.operands = np.zeros(30, dtype=np.uint8)
+        self.memory_decimal = np.zeros(30, dtype=np.int8)
+        self.fused = np.zeros(30, dtype=np.uint8)  # see _fuse
+        self.input_buffer = np.zeros(0, dtype=np.int64)
+        self._input_head = 0  # next unread index in input_buffer
+        self.output_buffer = np.zeros(_OUTPUT_CHUNK, dtype=np.int64)
+        self._output_len = 0  # values written to output_buffer
+
+    def _execute_halt(self, data):
         raise ValueError('Attempted to execute a HALT')
 
     def _execute_jump(self, data):
-        if type(data) is not int or data < 0 or data > 29:
-            raise ValueError(f'Invalid JUMP address {data}')
         self.pc = data
 
     def _execute_jzer(self, data):
-        if type(data) is not int or data < 0 or data > 29:
-            raise ValueError(f'Invalid JZER address {data}')
         if self.ac == 0:
             self.pc = data
         else:
             self.pc += 1
 
     def _execute_jpos(self, data):
-        if type(data) is not int or data < 0 or data > 29:
-            raise ValueError(f'Invalid JPOS address {data}')
         if self.ac > 0:
             self.pc = data
         else:
             self.pc += 1
 
     def _execute_load(self, data):
-        if type(data) is not int or data < 0 or data > 30:
-            raise ValueError(f'Invalid LOAD address {data}')
-        if data != 30:
-            self.ac = self.memory[data].decimal
-        else:  # read input
-            self.ac = self.input_buffer.popleft()
+        self.ac = int(self.memory_decimal[data])
+        self.pc += 1
+
+    def _execute_load_input(self, data):
+        if self._input_head >= len(self.input_buffer):
+            raise IndexError('Input buffer is empty')
+        self.ac = int(self.input_buffer[self._input_head])
+        self._input_head += 1
         self.pc += 1
 
     def _execute_stor(self, data):
-        if type(data) is not int or data < 0 or data > 31 or data == 30:
-            raise ValueError(f'Invalid STOR address {data}')
-        if data != 31:
-            self.memory[data] = MemoryLocation(decimal=self.ac)
-        else:  # write output
-            self.output_buffer.append(self.ac)
+        if not -128 <= self.ac < 128:
+            raise ValueError('Overflow!')
+        self._write_cell(data, self.ac)
+        self.pc += 1
+
+    def _execute_stor_output(self, data):
+        if self._output_len == len(self.output_buffer):
+            self.output_buffer = np.concatenate(
+                (self.output_buffer, np.zeros_like(self.output_buffer)))
+        self.output_buffer[self._output_len] = self.ac
+        self._output_len += 1
         self.pc += 1
 
     def _execute_add(self, data):
-        if type(data) is not int or data < 0 or data > 29:
-            raise ValueError(f'Invalid ADD address {data}')
-        self.ac += self.memory[data].decimal
+        self.ac += int(self.memory_decimal[data])
         self.pc += 1
 
     def _execute_sub(self, data):
-        if type(data) is not int or data < 0 or data > 29:
-            raise ValueError(f'Invalid SUB address {data}')
-        self.ac -= self.memory[data].decimal
+        self.ac -= int(self.memory_decimal[data])
         self.pc += 1
 
-    @staticmethod
-    def _strip_comment(str_):
-        try:
-            return str_[:str_.index('#')]
-        except ValueError:  # no comment on line
-            return str_
-
-    def _inline_labels(self, program):
-        new_program = []
-        i = 0
-        while i < len(program):
-            line = program[i]
-            if line[-1] == ':' and i + 1 < len(program):
-                new_program.append('{} {}'.format(line, program[i+1]))
-                i += 1
-            else:
-                new_program.append(line)
-            i += 1
-        return new_program
+    def _write_cell(self, idx, decimal):
+        """Store an already range-checked -128..127 value in a cell."""
+        operand = decimal & 0x1F
+        self.memory_decimal[idx] = decimal
+        self.opcodes[idx] = dispatch_opcode((decimal >> 5) & 7, operand)
+        self.operands[idx] = operand
+        self.fused[max(0, idx - 2):idx + 1] = 0  # may cover this cell
+
+    def memory_locations(self):
+        """Materialize memory as a list of MemoryLocation objects."""
+        return [MemoryLocation(decimal=decimal)
+                for decimal in self.memory_decimal.tolist()]
 
     def _fill_symbol_table(self, program):
         for idx, line in enumerate(program):
@@ -143,6 +209,8 @@ class CPU:
             return ['stor', '11111']
         elif tokens[0] == 'halt':
             return ['halt', '00000']
+        elif tokens[0] == 'store':
+            return ['stor'] + tokens[1:]
         return tokens
 
     def _assemble_instruction(self, idx, line, tokens):
@@ -154,23 +222,29 @@ class CPU:
 
         if data in self._symbol_table:  # expand if label is found
             data = self._symbol_table[data]
-        else:  # otherwise validate that it is a number
-            try:
-                data = int(data, base=2)
-            except ValueError:
-                try:
-                    data = int(data)
-                except ValueError:
-                    raise ValueError(f'Invalid operand {data} on line {idx}')
-        self.memory[idx] = MemoryLocation(instruction=(instruction, data))
+        elif len(data) == 5 and not data.strip('01'):  # 5-bit binary
+            data = int(data, base=2)
+        elif data.isdecimal():
+            data = int(data)
+        else:
+            raise ValueError(f'Invalid operand {data} on line {idx}')
+        opcode = INSTR_TO_OPCODE[instruction]
+        # must fit the 5-bit operand field and be an address the opcode takes
+        if not 0 <= data < 32 or not valid_operand(opcode, data):
+            raise ValueError(f'Invalid operand {data} on line {idx}')
+        decimal = 32 * opcode + data
+        self._write_cell(idx, decimal - 256 if decimal >= 128 else decimal)
 
     def _assemble_data(self, idx, line, tokens):
         if len(tokens) != 1:
             raise ValueError(f'Illegal line {idx}:{line}')
         try:
-            self.memory[idx] = MemoryLocation(decimal=int(tokens[0]))
+            decimal = int(tokens[0])
         except ValueError:
             raise ValueError(f'Invalid data value {tokens[0]}')
+        if not -128 <= decimal < 128:
+            raise ValueError(f'Invalid data value {tokens[0]}')
+        self._write_cell(idx, decimal)
 
     def _assemble(self, program):
         for idx, line in enumerate(program):
@@ -180,7 +254,8 @@ class CPU:
             tokens = tokens.split()
 
             # assemble line
-            if tokens[0] not in self._JUMP_TABLE:
+            mnemonic = tokens[0]
+            if mnemonic not in INSTR_TO_OPCODE and mnemonic not in PSEUDO_OPS:
                 self._assemble_data(idx, line, tokens)
             else:
                 self._assemble_instruction(idx, line, tokens)
@@ -192,21 +267,82 @@ class CPU:
         except IOError:
             raise IOError(f'File {program_filename} not found.')
 
-        program = [CPU._strip_comment(line).lower().strip()
-                   for line in program.splitlines() if len(line) > 0]
-        program = [line for line in program if len(line) > 0]
-        program = self._inline_labels(program)
-        self._fill_symbol_table(program)
-        self._assemble(program)
-
-        self.input_buffer = deque(input_buffer)
-        while self.memory[self.pc].instruction != 'halt':
-            instruction = self.memory[self.pc].instruction
-            operand = self.memory[self.pc].operand
-            self._JUMP_TABLE[instruction](data=operand)
+        compiled = compile_program(program)
+        opcodes, operands, memory_decimal, fused, symbols = compiled
+        self.opcodes[:] = opcodes
+        self.operands[:] = operands
+        self.memory_decimal[:] = memory_decimal
+        self.fused[:] = fused
+        self._symbol_table = dict(symbols)
+
+        self.input_buffer = np.array(input_buffer, dtype=np.int64)
+        self._input_head = 0
+        # Imported here so that only this method needs Numba.
+        from simulator_jit import run_no_input, run_with_input
+        # Most programs never READ, so skip the input branch for them. A
+        # READ written by self-modifying code stops run_no_input like any
+        # instruction it cannot complete, and switches to run_with_input.
+        if (self.opcodes == LOAD_INPUT).any():
+            run = run_with_input
+        else:
+            run = run_no_input
+        while True:
+            self.pc, self.ac, self._input_head, self._output_len = run(
+                self.opcodes, self.operands, self.memory_decimal, self.fused,
+                self.pc, self.ac, self.input_buffer, self._input_head,
+                self.output_buffer, self._output_len)
+            # Handlers take plain ints; .item() converts once, right here.
+            opcode = self.opcodes.item(self.pc)
+            if opcode == HALT:
+                break
+            # run stopped short of this instruction: either it is invalid,
+            # or the handler raises its error or (for a WRITE with output
+            # full) grows the output buffer.
+            operand = self.operands.item(self.pc)
+            check_operand(opcode, operand)
+            self._dispatch[opcode](operand)
+            if opcode == LOAD_INPUT:
+                run = run_with_input
 
     def get_state(self):
-        return (self.ac, self.memory, self.output_buffer)
+        """Return (ac, memory values, output) as plain Python lists."""
+        output = self.output_buffer[:self._output_len].tolist()
+        return (self.ac, self.memory_decimal.tolist(), output)
+
+
+def _parse(source):
+    """Split source into one lowercased, comment-free line per cell."""
+    program = []
+    label = None
+    for line in source.splitlines():
+        line = line.partition('#')[0].strip().lower()
+        if not line:
+            continue
+        if label is not None:
+            program.append(f'{label} {line}')
+            label = None
+        elif line[-1] == ':':  # joined to the next line
+            label = line
+        else:
+            program.append(line)
+    if label is not None:
+        program.append(label)
+    return program
+
+
+@lru_cache(maxsize=128)
+def compile_program(source):
+    """Assemble source into CPU arrays plus a symbol table, cached by text."""
+    cpu = CPU()
+    program = _parse(source)
+    cpu._fill_symbol_table(program)
+    cpu._assemble(program)
+    cpu.fused = _fuse(cpu.opcodes, cpu.operands)
+    # Shared by every caller of the cache: callers copy, never mutate.
+    arrays = (cpu.opcodes, cpu.operands, cpu.memory_decimal, cpu.fused)
+    for array in arrays:
+        array.flags.writeable = False
+    return arrays + (cpu._symbol_table,)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,127 @@
+"""Numba-compiled run loop behind CPU.run_program.
+
+Imported by run_program on first use, so importing simulator (as the web
+app does) never loads Numba.
+"""
+
+import numpy as np
+from numba import njit
+
+from simulator import (ADD, HALT, JPOS, JUMP, JZER, LOAD, LOAD_ADD_STOR,
+                       LOAD_INPUT, LOAD_SUB_STOR, LOAD_WRITE, STOR,
+                       STOR_OUTPUT, SUB_JPOS)
+
+
+@njit(cache=True)
+def _store(opcodes, operands, memory_decimal, fused, address, value):
+    """Write a value into a memory cell from compiled code."""
+    opcode = (value >> 5) & 7
+    operand = value & 0x1F
+    if opcode == LOAD and operand == 30:
+        opcode = LOAD_INPUT
+    elif opcode == STOR and operand == 31:
+        opcode = STOR_OUTPUT
+    memory_decimal[address] = value
+    opcodes[address] = opcode
+    operands[address] = operand
+    # Unfuse any super-instruction covering the cell; it decoded the old one.
+    for head in range(max(0, address - 2), address + 1):
+        fused[head] = 0
+
+
+@njit(inline='always')
+def _run(opcodes, operands, memory_decimal, fused, pc, ac, input_buf,
+         input_head, output_buf, output_len, with_input):
+    """Execute from pc until a HALT or an instruction it cannot complete."""
+    # An instruction it cannot complete (invalid address, STOR overflow,
+    # READ without input, WRITE with output_buf full) is left for
+    # run_program's Python handlers. Super-instructions that cannot complete
+    # fall through to single steps.
+    size = opcodes.shape[0]
+    while pc < size:
+        fusion = fused[pc]
+        if fusion == LOAD_ADD_STOR or fusion == LOAD_SUB_STOR:
+            value = np.int64(memory_decimal[operands[pc]])
+            if fusion == LOAD_ADD_STOR:
+                value += memory_decimal[operands[pc + 1]]
+            else:
+                value -= memory_decimal[operands[pc + 1]]
+            if -128 <= value < 128:
+                ac = value
+                _store(opcodes, operands, memory_decimal, fused,
+                       operands[pc + 2], ac)
+                pc += 3
+                continue
+        elif fusion == LOAD_WRITE:
+            if output_len < output_buf.shape[0]:
+                ac = np.int64(memory_decimal[operands[pc]])
+                output_buf[output_len] = ac
+                output_len += 1
+                pc += 2
+                continue
+        elif fusion == SUB_JPOS:
+            ac -= memory_decimal[operands[pc]]
+            pc = operands[pc + 1] if ac > 0 else pc + 2
+            continue
+
+        opcode = opcodes[pc]
+        operand = operands[pc]
+        if opcode == HALT:
+            break
+        elif opcode == JUMP or opcode == JZER or opcode == JPOS:
+            if operand >= size:
+                break
+            if (opcode == JUMP or (opcode == JZER and ac == 0)
+                    or (opcode == JPOS and ac > 0)):
+                pc = operand
+            else:
+                pc += 1
+            continue
+        elif opcode == LOAD_INPUT:
+            if not with_input or input_head == input_buf.shape[0]:
+                break
+            ac = input_buf[input_head]
+            input_head += 1
+        elif opcode == STOR_OUTPUT:
+            if output_len == output_buf.shape[0]:
+                break
+            output_buf[output_len] = ac
+            output_len += 1
+        elif operand >= size:
+            break
+        elif opcode == LOAD:
+            ac = np.int64(memory_decimal[operand])
+        elif opcode == STOR:
+            if not -128 <= ac < 128:
+                break
+            _store(opcodes, operands, memory_decimal, fused, operand, ac)
+        elif opcode == ADD:
+            ac += np.int64(memory_decimal[operand])
+        else:  # SUB
+            ac -= np.int64(memory_decimal[operand])
+        pc += 1
+    return pc, ac, input_head, output_len
+
+
+# Both variants are compiled (or loaded from the on-disk cache) when this
+# module is imported rather than on their first call. Arrays are
+# C-contiguous: uint8 opcodes, operands and fused, int8 memory_decimal,
+# then int64 input and output buffers.
+_RUN_SIGNATURE = ('UniTuple(int64, 4)(uint8[::1], uint8[::1], int8[::1],'
+                  ' uint8[::1], int64, int64, int64[::1], int64, int64[::1],'
+                  ' int64)')
+
+
+@njit(_RUN_SIGNATURE, cache=True)
+def run_with_input(opcodes, operands, memory_decimal, fused, pc, ac,
+                   input_buf, input_head, output_buf, output_len):
+    return _run(opcodes, operands, memory_decimal, fused, pc, ac, input_buf,
+                input_head, output_buf, output_len, True)
+
+
+@njit(_RUN_SIGNATURE, cache=True)
+def run_no_input(opcodes, operands, memory_decimal, fused, pc, ac,
+                 input_buf, input_head, output_buf, output_len):
+    """_run for programs with no READ, with the input branch compiled out."""
+    return _run(opcodes, operands, memory_decimal, fused, pc, ac, input_buf,
+                input_head, output_buf, output_len, False)
@@ -1,9 +1,13 @@
+import json
+import os
+import tempfile
 import unittest
 import threading
 import time
 from unittest.mock import patch
 
-from app import app
+from app import app, sessions, SessionStore, SteppableCPU, SESSION_HEADER
+from simulator import CPU
 
 
 PROGRAM_A = """
@@ -24,12 +28,84 @@ INFINITE_LOOP_PROGRAM = """
 jump 0
 """
 
+SELF_MODIFYING_PROGRAM = """
+load patch
+stor target
+target: halt
+halt
+patch: -65
+"""
+
+ECHO_PROGRAM = """
+read
+write
+read
+write
+halt
+"""
+
+COUNTDOWN_PROGRAM = """
+loop: load count
+write
+sub one
+stor count
+jpos loop
+halt
+count: 40
+one: 1
+"""
+
+# Sums an array by patching the operand of its own ADD on every pass.
+ARRAY_SUM_PROGRAM = """
+loop: load sum
+next: add array
+stor sum
+load next
+add one
+stor next
+load count
+sub one
+stor count
+jpos loop
+load sum
+write
+halt
+sum: 0
+one: 1
+count: 8
+array: 1
+2
+3
+4
+5
+6
+7
+8
+"""
+
+
+class TokenClient:
+    """Test client that echoes the /api/load session token like the web UI."""
+
+    def __init__(self):
+        self.client = app.test_client()
+        self.token = None
+
+    def post(self, path, headers=None, **kwargs):
+        headers = dict(headers or {})
+        if self.token:
+            headers.setdefault(SESSION_HEADER, self.token)
+        res = self.client.post(path, headers=headers, **kwargs)
+        if path == "/api/load" and res.status_code == 200:
+            self.token = res.get_json()["token"]
+        return res
+
 
 class SessionIsolationTests(unittest.TestCase):
     def setUp(self):
         app.config["TESTING"] = True
-        self.client_a = app.test_client()
-        self.client_b = app.test_client()
+        self.client_a = TokenClient()
+        self.client_b = TokenClient()
 
     def test_sessions_are_isolated(self):
         res = self.client_a.post("/api/load", json={"code": PROGRAM_A, "input": []})
@@ -53,6 +129,33 @@ class SessionIsolationTests(unittest.TestCase):
         self.assertEqual(res.status_code, 400)
         self.assertEqual(res.get_json()["error"], "No program loaded")
 
+    def test_load_does_not_adopt_unknown_tokens(self):
+        res = self.client_a.post(
+            "/api/load", json={"code": PROGRAM_A}, headers={SESSION_HEADER: "guess"}
+        )
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.get_json()["token"], "guess")
+
+        token = self.client_a.token
+        res = self.client_a.post("/api/load", json={"code": PROGRAM_B})
+        self.assertEqual(res.get_json()["token"], token)
+
+    def test_failed_loads_do_not_leak_session_locks(self):
+        locks = len(sessions._session_locks)
+        for _ in range(20):
+            res = self.client_a.post("/api/load", json={"code": "jump 30"})
+            self.assertEqual(res.status_code, 400)
+            res = self.client_a.post("/api/load", json={"code": "halt", "input": ["x"]})
+            self.assertEqual(res.status_code, 400)
+        self.assertEqual(len(sessions._session_locks), locks)
+
+        # A failed reload keeps the existing session and its lock.
+        self.client_a.post("/api/load", json={"code": PROGRAM_A})
+        self.client_a.post("/api/load", json={"code": "jump 30"})
+        self.assertEqual(len(sessions._session_locks), locks + 1)
+        data = self.client_a.post("/api/run", json={}).get_json()
+        self.assertEqual(data["output"], [7])
+
     def test_run_times_out_for_infinite_loop(self):
         load = self.client_a.post("/api/load", json={"code": INFINITE_LOOP_PROGRAM, "input": []})
         self.assertEqual(load.status_code, 200)
@@ -69,9 +172,8 @@ class SessionIsolationTests(unittest.TestCase):
         load = self.client_a.post("/api/load", json={"code": "halt", "input": []})
         self.assertEqual(load.status_code, 200)
 
-        session_cookie = self.client_a.get_cookie("session")
-        self.assertIsNotNone(session_cookie)
-        self.client_b.set_cookie("session", session_cookie.value)
+        self.assertIsNotNone(self.client_a.token)
+        self.client_b.token = self.client_a.token
 
         results = {}
 
@@ -142,5 +244,327 @@ class SessionIsolationTests(unittest.TestCase):
         self.assertLess(results["register_elapsed"], 0.15)
 
 
+class ExecutionTests(unittest.TestCase):
+    def setUp(self):
+        app.config["TESTING"] = True
+        self.client = TokenClient()
+        # Compile from the first step, so runs go through generated code.
+        patcher = patch("app.SteppableCPU._COMPILE_AFTER_STEPS", 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_memory_edit_rewrites_code(self):
+        res = self.client.post("/api/load", json={"code": PROGRAM_A, "input": []})
+        self.assertEqual(res.status_code, 200)
+
+        # Replace the HALT at address 2 with a second WRITE (stor 31).
+        res = self.client.post("/api/memory", json={"address": 2, "decimal": -65})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.get_json()["memory"][2]["instr"], "stor 31")
+
+        data = self.client.post("/api/run", json={}).get_json()
+        self.assertEqual(data["output"], [7, 7])
+        self.assertTrue(data["halted"])
+        self.assertIsNone(data["error"])
+
+    def test_invalid_addresses(self):
+        res = self.client.post("/api/load", json={"code": "jump 30"})
+        self.assertEqual(res.status_code, 400)
+
+        # Cells rewritten at run time are still checked when executed.
+        for path in ("/api/run", "/api/step"):
+            self.client.post("/api/load", json={"code": PROGRAM_A})
+            self.client.post("/api/memory", json={"address": 0, "decimal": 62})
+            data = self.client.post(path, json={}).get_json()
+            self.assertEqual(data["error"], "Invalid JUMP address 30")
+            self.assertEqual(data["pc"], 0)
+
+    def test_hot_loop_output_matches_step_by_step(self):
+        self.client.post("/api/load", json={"code": COUNTDOWN_PROGRAM, "input": []})
+        data = self.client.post("/api/run", json={}).get_json()
+        self.assertEqual(data["output"], list(range(40, 0, -1)))
+        self.assertTrue(data["halted"])
+
+        data = self.client.post(
+            "/api/load", json={"code": COUNTDOWN_PROGRAM, "input": []}
+        ).get_json()
+        while not data["halted"]:
+            data = self.client.post("/api/step", json={}).get_json()
+        self.assertEqual(data["output"], list(range(40, 0, -1)))
+
+    def test_run_executes_code_written_by_stor(self):
+        self.client.post("/api/load", json={"code": SELF_MODIFYING_PROGRAM, "input": []})
+        data = self.client.post("/api/run", json={}).get_json()
+        self.assertEqual(data["output"], [-65])
+        self.assertEqual(data["memory"][2]["instr"], "stor 31")
+        self.assertEqual(data["pc"], 3)
+        self.assertTrue(data["halted"])
+
+        # Reloading the same source starts from the unmodified program.
+        data = self.client.post(
+            "/api/load", json={"code": SELF_MODIFYING_PROGRAM, "input": []}
+        ).get_json()
+        self.assertEqual(data["memory"][2]["instr"], "halt 0")
+
+    def test_self_modifying_loop_stops_recompiling(self):
+        self.client.post("/api/load", json={"code": ARRAY_SUM_PROGRAM})
+        with patch(
+            "app.SteppableCPU._compile_program",
+            autospec=True,
+            side_effect=SteppableCPU._compile_program,
+        ) as compile_program:
+            data = self.client.post("/api/run", json={}).get_json()
+        self.assertEqual(data["output"], [36])
+        self.assertTrue(data["halted"])
+        self.assertLessEqual(
+            compile_program.call_count, SteppableCPU._MAX_RECOMPILES + 1
+        )
+
+    def test_running_past_the_last_cell(self):
+        data = self.client.post("/api/load", json={"code": "load 0\n" * 30}).get_json()
+        for _ in range(31):
+            data = self.client.post("/api/step", json={}).get_json()
+        self.assertEqual(data["error"], "Invalid PC 30")
+
+        # Stepped during warm-up as well as through compiled code.
+        for compile_after in (0, 1024):
+            with patch.object(SteppableCPU, "_COMPILE_AFTER_STEPS", compile_after):
+                self.client.post("/api/load", json={"code": "load 0\n" * 30})
+            data = self.client.post("/api/run", json={}).get_json()
+            self.assertEqual(data["error"], "Invalid PC 30")
+            self.assertEqual(data["pc"], 30)
+
+    def test_run_n_counts_steps_taken_before_an_error(self):
+        # Stepped during warm-up as well as through compiled code.
+        for compile_after in (0, 1024):
+            with patch.object(SteppableCPU, "_COMPILE_AFTER_STEPS", compile_after):
+                cpu = SteppableCPU()
+                cpu.load_program("load 4\nadd 4\nwrite\nsub 4\n62\n")
+            self.assertEqual(cpu.run_n(59), 4)
+            self.assertEqual(cpu.error, "Invalid JUMP address 30")
+            self.assertEqual(cpu.output_buffer, [124])
+
+    def test_run_waits_for_input_and_resumes(self):
+        self.client.post("/api/load", json={"code": ECHO_PROGRAM, "input": [5]})
+        data = self.client.post("/api/run", json={}).get_json()
+        self.assertEqual(data["output"], [5])
+        self.assertEqual(data["input"], [])
+        self.assertTrue(data["waiting_for_input"])
+
+        data = self.client.post("/api/input", json={"value": -6}).get_json()
+        self.assertEqual(data["input"], [-6])
+        data = self.client.post("/api/run", json={}).get_json()
+        self.assertEqual(data["output"], [5, -6])
+        self.assertTrue(data["halted"])
+
+    def test_load_rejects_out_of_range_input(self):
+        res = self.client.post("/api/load", json={"code": ECHO_PROGRAM, "input": [128]})
+        self.assertEqual(res.status_code, 400)
+
+    def test_symbols_are_only_sent_on_load(self):
+        load = self.client.post("/api/load", json={"code": COUNTDOWN_PROGRAM}).get_json()
+        self.assertEqual(load["symbols"], {"loop": 0, "count": 6, "one": 7})
+
+        step = self.client.post("/api/step", json={}).get_json()
+        self.assertNotIn("symbols", step)
+
+    def test_step_delta_reports_only_changes(self):
+        self.client.post("/api/load", json={"code": PROGRAM_A, "input": []})
+        first = self.client.post("/api/step_delta", json={}).get_json()
+        self.assertEqual(first["pc"], 1)
+        self.assertEqual(first["ac"], 7)
+        self.assertEqual(first["changed"], [])
+        self.assertEqual(first["output_appended"], [])
+
+        second = self.client.post("/api/step_delta", json={}).get_json()
+        self.assertEqual(second["output_appended"], [7])
+        self.assertNotIn("memory", second)
+
+        self.client.post("/api/load", json={"code": SELF_MODIFYING_PROGRAM, "input": []})
+        self.client.post("/api/step_delta", json={})
+        delta = self.client.post("/api/step_delta", json={}).get_json()
+        self.assertEqual(delta["changed"], [{"addr": 2, "decimal": -65, "instr": "stor 31"}])
+
+    def test_run_stream_sends_deltas_until_halt(self):
+        self.client.post("/api/load", json={"code": COUNTDOWN_PROGRAM, "input": []})
+        res = self.client.post("/api/run_stream", json={})
+        self.assertEqual(res.mimetype, "text/event-stream")
+        body = res.get_data(as_text=True)
+        res.close()
+
+        events = [json.loads(chunk[len("data: "):])
+                  for chunk in body.split("\n\n") if chunk]
+        output = [value for event in events for value in event["output_appended"]]
+        self.assertEqual(output, list(range(40, 0, -1)))
+        self.assertTrue(events[-1]["halted"])
+
+        # The session lock is released once the stream closes.
+        released = threading.Event()
+
+        def do_register():
+            self.client.post("/api/register", json={"register": "ac", "value": 1})
+            released.set()
+
+        threading.Thread(target=do_register, daemon=True).start()
+        self.assertTrue(released.wait(2))
+
+
+class SessionStoreTests(unittest.TestCase):
+    def test_capacity_evicts_least_recently_used(self):
+        store = SessionStore(max_sessions=2, ttl_seconds=60)
+        store.put("a", "cpu-a")
+        store.put("b", "cpu-b")
+        store.get("a")
+        store.put("c", "cpu-c")
+        store.put("d", "cpu-d")
+
+        self.assertEqual(store.get("a"), "cpu-a")
+        self.assertIsNone(store.get("b"))
+        self.assertIsNone(store.lock_for("b"))
+
+    def test_stale_sessions_are_dropped(self):
+        store = SessionStore(max_sessions=10, ttl_seconds=60)
+        with patch("app.time", return_value=1000):
+            store.put("old", "cpu-old")
+        with patch("app.time", return_value=1030):
+            store.put("recent", "cpu-recent")
+        with patch("app.time", return_value=1080):
+            store.put("new", "cpu-new")
+            self.assertIsNone(store.get("old"))
+            self.assertEqual(store.get("recent"), "cpu-recent")
+
+
+class CPUTests(unittest.TestCase):
+    def run_program(self, code, input_buffer=(), cpu_class=CPU):
+        with tempfile.NamedTemporaryFile("w", suffix=".hymn", delete=False) as f:
+            f.write(code)
+        self.addCleanup(os.remove, f.name)
+        self.cpu = cpu_class()
+        self.cpu.run_program(f.name, input_buffer=input_buffer)
+        return self.cpu
+
+    def test_countdown(self):
+        ac, memory, output = self.run_program(COUNTDOWN_PROGRAM).get_state()
+        self.assertEqual(output, list(range(40, 0, -1)))
+        self.assertEqual(ac, 0)
+        self.assertEqual(memory[6:8], [0, 1])
+
+    def test_steppable_cpu_matches_cpu(self):
+        for program in (COUNTDOWN_PROGRAM, SELF_MODIFYING_PROGRAM):
+            cpu = self.run_program(program)
+            steppable = self.run_program(program, cpu_class=SteppableCPU)
+            self.assertEqual(steppable.get_state(), cpu.get_state())
+            self.assertEqual(
+                list(map(str, steppable.memory_locations())),
+                list(map(str, cpu.memory_locations())),
+            )
+        with self.assertRaises(IndexError):
+            self.run_program(ECHO_PROGRAM, (1,), cpu_class=SteppableCPU)
+
+    def test_self_modifying_code(self):
+        # The second run reuses the cached assembly, which must be unchanged.
+        for _ in range(2):
+            cpu = self.run_program(SELF_MODIFYING_PROGRAM)
+            self.assertEqual(cpu.get_state()[2], [-65])
+            self.assertEqual(cpu.pc, 3)
+
+    def test_rewriting_a_fused_instruction(self):
+        # Cells 0-2 run as one LOAD/ADD/STOR super-instruction until the
+        # first pass rewrites cell 1 from "add b" to "sub b".
+        program = """
+        loop: load a
+        add b
+        stor c
+        load c
+        write
+        load patch
+        stor 1
+        load n
+        sub one
+        stor n
+        jpos loop
+        halt
+        a: 10
+        b: 3
+        c: 0
+        n: 2
+        one: 1
+        patch: -19
+        """
+        cpu = self.run_program(program)
+        self.assertEqual(cpu.get_state()[2], [13, 7])
+        self.assertEqual(str(cpu.memory_locations()[1]), "sub 13")
+
+    def test_input_and_long_output(self):
+        # Writes each input 100 times, more than one batch of output, then
+        # fails reading past the end of the input.
+        program = """
+        loop: read
+        stor value
+        load count
+        stor left
+        inner: load value
+        write
+        load left
+        sub one
+        stor left
+        jpos inner
+        jump loop
+        value: 0
+        left: 0
+        count: 100
+        one: 1
+        """
+        with self.assertRaises(IndexError):
+            self.run_program(program, input_buffer=(3, -4, 5))
+        output = self.cpu.get_state()[2]
+        self.assertEqual(output, [3] * 100 + [-4] * 100 + [5] * 100)
+        self.assertEqual(self.cpu.pc, 0)
+
+    def test_read_written_by_the_program(self):
+        # No cell starts out as a READ, so this runs without input support
+        # until it builds "read" (-98) in slot and loops over it.
+        program = """
+        load almost
+        add one
+        stor slot
+        slot: halt
+        write
+        load left
+        sub one
+        stor left
+        jpos slot
+        halt
+        almost: -99
+        left: 3
+        one: 1
+        """
+        output = self.run_program(program, input_buffer=(4, -5, 6)).get_state()[2]
+        self.assertEqual(output, [4, -5, 6])
+        self.assertEqual(str(self.cpu.memory_locations()[3]), "load 30")
+
+    def test_store_overflow_raises(self):
+        with self.assertRaises(ValueError):
+            self.run_program("load big\nadd big\nstor big\nhalt\nbig: 100\n")
+
+    def test_rewritten_cell_with_invalid_address_raises(self):
+        with self.assertRaisesRegex(ValueError, "Invalid JUMP address 30"):
+            self.run_program("load bad\nstor 2\nhalt\nbad: 62\n")
+        self.assertEqual(self.cpu.pc, 2)
+
+    def test_pseudo_ops(self):
+        cpu = self.run_program("read\nstore 4\nload 4\nwrite\nhalt\n", (5,))
+        self.assertEqual(cpu.get_state()[2], [5])
+        self.assertEqual(str(cpu.memory_locations()[1]), "stor 4")
+
+    def test_operands_are_decimal_unless_five_binary_digits(self):
+        program = "load 00101\nwrite\nload 10\nwrite\nhalt\n7\n0\n0\n0\n0\n9\n"
+        self.assertEqual(self.run_program(program).get_state()[2], [7, 9])
+
+    def test_rejects_operand_outside_field(self):
+        with self.assertRaises(ValueError):
+            self.run_program("load 32\nhalt\n")
+
+
 if __name__ == "__main__":
     unittest.main()